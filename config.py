@@ -0,0 +1,21 @@
+import configparser
+from functools import lru_cache
+
+CONFIG_FILENAME = "dwh.cfg"
+
+
+@lru_cache(maxsize=1)
+def get_config() -> configparser.ConfigParser:
+    """
+    Parse dwh.cfg once and return the same ConfigParser on every call.
+
+    Returns:
+        configparser.ConfigParser: The parsed configuration.
+
+    Raises:
+        FileNotFoundError: If dwh.cfg is missing.
+    """
+    config = configparser.ConfigParser()
+    with open(CONFIG_FILENAME) as conf:
+        config.read_file(conf)
+    return config
@@ -1,28 +1,29 @@
-import configparser
-
-import psycopg2
-
-from sql_queries import create_table_queries, drop_table_queries
+from config import get_config
+from db import create_pool, run_all, run_concurrently, run_on_own_connection
+from sql_queries import (
+    drop_table_queries,
+    independent_create_table_queries,
+    songplay_table_create,
+)
 
 
 def drop_tables(cur, conn):
     """
     Drops tables if already created using SQL commands
-    from sql_queries.py
+    from sql_queries.py, pipelined on an autocommit connection
     """
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+    run_all(cur, conn, drop_table_queries)
 
 
-def create_tables(cur, conn):
+def create_tables(pool):
     """
     Creates tables for analytics tables and staging tables using SQL commands
     from sql_queries.py
+    Tables without foreign keys are created concurrently, songplays is
+    created once the dimension tables it references exist
     """
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+    run_concurrently(pool, independent_create_table_queries)
+    run_on_own_connection(pool, songplay_table_create)
 
 
 def main():
@@ -31,22 +32,15 @@ def main():
     Drops tables (if necessary) and creates tables for analytics tables
     and staging tables
     """
-    config = configparser.ConfigParser()
-    config.read("dwh.cfg")
-
-    conn = psycopg2.connect(
-        host=config["CLUSTER"]["host"],
-        dbname=config["CLUSTER"]["db_name"],
-        user=config["CLUSTER"]["db_user"],
-        password=config["CLUSTER"]["db_password"],
-        port=config["CLUSTER"]["db_port"],
-    )
-    cur = conn.cursor()
-
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-
-    conn.close()
+    # Autocommit connections: the pipelined drops run in a single implicit
+    # transaction up to the pipeline Sync, and each CREATE commits on its own
+    with create_pool(get_config(), autocommit=True) as pool:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+
+            drop_tables(cur, conn)
+
+        create_tables(pool)
 
 
 if __name__ == "__main__":
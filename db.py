@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg_pool import ConnectionPool
+
+
+def create_pool(config, min_size=1, max_size=8, autocommit=False):
+    """
+    Creates a thread-safe pool of connections to the AWS Redshift Cluster
+    using the credentials inside dwh.cfg
+    """
+    return ConnectionPool(
+        min_size=min_size,
+        max_size=max_size,
+        open=True,
+        kwargs={
+            "host": config["CLUSTER"]["host"],
+            "dbname": config["CLUSTER"]["db_name"],
+            "user": config["CLUSTER"]["db_user"],
+            "password": config["CLUSTER"]["db_password"],
+            "port": config["CLUSTER"]["db_port"],
+            "autocommit": autocommit,
+        },
+    )
+
+
+def run_all(cur, conn, queries):
+    """
+    Sends a list of SQL statements to Redshift back to back in pipeline
+    mode and commits once at the end, unless the connection autocommits
+    """
+    with conn.pipeline():
+        for query in queries:
+            cur.execute(query)
+    if not conn.autocommit:
+        conn.commit()
+
+
+def run_on_own_connection(pool, query):
+    """
+    Runs a single SQL statement on its own pooled connection and commits it
+    unless the connection autocommits, so that concurrent statements run
+    in separate Redshift sessions
+    """
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        if not conn.autocommit:
+            conn.commit()
+
+
+def run_concurrently(pool, queries):
+    """
+    Runs independent SQL statements in parallel, one pooled connection
+    per statement, and waits for all of them to finish
+    """
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [
+            executor.submit(run_on_own_connection, pool, query) for query in queries
+        ]
+        for future in futures:
+            future.result()
@@ -1,50 +1,56 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+from config import get_config
+from db import create_pool, run_all, run_concurrently
+from sql_queries import (
+    analyze_staging_queries,
+    copy_table_queries,
+    dimension_table_queries,
+    fact_table_queries,
+    query_params,
+)
+
+
+def load_staging_tables(pool, params):
+    """
+    Loads data from AWS S3 to staging tables using
+    SQL statements from sql_queries.py filled in with params
+    Both staging tables are loaded concurrently
+    """
+    run_concurrently(pool, [query.format(**params) for query in copy_table_queries])
 
 
-def load_staging_tables(cur, conn):
+def analyze_staging_tables(cur, conn):
     """
-    Loads data from AWS S3 to staging tables using
-    SQL statements from sql_queries.py
+    Refreshes the staging tables statistics before they are queried
+    by the inserts, since the COPY statements skip it
     """
-    for query in copy_table_queries:
-        cur.execute(query)
-        conn.commit()
+    run_all(cur, conn, analyze_staging_queries)
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, pool, params):
     """
     Inserts data from staging to analytics tables using
     SQL statements from sql_queries.py
+    The dimension tables don't depend on each other and are loaded
+    concurrently, then the fact table is loaded once they are all done
     """
-    for query in insert_table_queries:
-        cur.execute(query)
-        conn.commit()
+    run_concurrently(pool, dimension_table_queries)
+
+    run_all(cur, conn, [query.format(**params) for query in fact_table_queries])
 
 
 def main():
     """
     Connects to AWS Redshift Cluster using credentials inside dwh.cfg
-    Loads data from S3 to staging tables
+    Loads data from S3 to staging tables and analyzes them
     Inserts data from staging to analytics tables
     """
-    config = configparser.ConfigParser()
-    config.read('dwh.cfg')
-
-    conn = psycopg2.connect(
-        host=config["CLUSTER"]["host"],
-        dbname=config["CLUSTER"]["db_name"],
-        user=config["CLUSTER"]["db_user"],
-        password=config["CLUSTER"]["db_password"],
-        port=config["CLUSTER"]["db_port"],
-    )
-    cur = conn.cursor()
-
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    with create_pool(get_config()) as pool, pool.connection() as conn:
+        cur = conn.cursor()
+        params = query_params()
 
-    conn.close()
+        load_staging_tables(pool, params)
+        analyze_staging_tables(cur, conn)
+        insert_tables(cur, conn, pool, params)
 
 
 if __name__ == "__main__":
@@ -1,66 +1,136 @@
-import configparser
 import json
-import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import boto3
 import fire
 import requests
-from botocore.exceptions import ClientError
-
-CONFIG_FILENAME = "dwh.cfg"
-config = configparser.ConfigParser()
-config.read_file(open(CONFIG_FILENAME))
-ACCESS_KEY_ID = config.get("AWS", "ACCESS_KEY_ID")
-SECRET_ACCESS_KEY = config.get("AWS", "SECRET_ACCESS_KEY")
-AWS_REGION = config.get("AWS", "AWS_REGION")
-CLUSTER_ID = config.get("CLUSTER", "cluster_id")
-DB_NAME = config.get("CLUSTER", "DB_NAME")
-DB_USER = config.get("CLUSTER", "DB_USER")
-DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
-DB_PORT = int(config.get("CLUSTER", "DB_PORT"))
-
-iam = boto3.client(
-    "iam",
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
-)
-
-ec2_client = boto3.client(
-    "ec2",
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
-)
-
-ec2_resource = boto3.resource(
-    "ec2",
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
-)
-
-redshift = boto3.client(
-    "redshift",
-    aws_access_key_id=ACCESS_KEY_ID,
-    aws_secret_access_key=SECRET_ACCESS_KEY,
-    region_name=AWS_REGION,
-)
+from botocore.exceptions import ClientError, WaiterError
+
+from config import CONFIG_FILENAME, get_config
+
+WAITER_CONFIG = {"Delay": 30, "MaxAttempts": 60}
+S3_POLICY_ARN = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+# Inline policy granting write access to the songplay_stage prefix only,
+# which UNLOAD of the songplays fact table needs
+SONGPLAY_STAGE_POLICY_NAME = "songplay_stage_write"
+IMDS_URL = "http://169.254.169.254/latest"
+IMDS_TIMEOUT = 0.5
+
+_SESSION = requests.Session()
+
+
+def _aws_credentials() -> dict:
+    """
+    Read the AWS credentials and region from dwh.cfg.
+
+    Returns:
+        dict: Keyword arguments for creating boto3 clients and resources.
+    """
+    config = get_config()
+    return {
+        "aws_access_key_id": config.get("AWS", "ACCESS_KEY_ID"),
+        "aws_secret_access_key": config.get("AWS", "SECRET_ACCESS_KEY"),
+        "region_name": config.get("AWS", "AWS_REGION"),
+    }
+
+
+# The boto3 clients are created on first use, not at import time
+
+
+@lru_cache(maxsize=1)
+def _iam():
+    """
+    Create the Boto3 IAM client on first use.
+
+    Returns:
+        boto3.client: The cached Boto3 IAM client.
+    """
+    return boto3.client("iam", **_aws_credentials())
+
+
+@lru_cache(maxsize=1)
+def _ec2_client():
+    """
+    Create the Boto3 EC2 client on first use.
+
+    Returns:
+        boto3.client: The cached Boto3 EC2 client.
+    """
+    return boto3.client("ec2", **_aws_credentials())
+
+
+@lru_cache(maxsize=1)
+def _ec2_resource():
+    """
+    Create the Boto3 EC2 resource on first use.
+
+    Returns:
+        boto3.resource: The cached Boto3 EC2 resource.
+    """
+    return boto3.resource("ec2", **_aws_credentials())
+
+
+@lru_cache(maxsize=1)
+def _redshift():
+    """
+    Create the Boto3 Redshift client on first use.
+
+    Returns:
+        boto3.client: The cached Boto3 Redshift client.
+    """
+    return boto3.client("redshift", **_aws_credentials())
+
+
+def songplay_stage_policy() -> str:
+    """
+    Build the inline IAM policy allowing writes to the `[S3] songplay_stage` prefix.
+
+    Returns:
+        str: The policy document as a JSON string.
+    """
+    stage = get_config().get("S3", "SONGPLAY_STAGE").strip("'")
+    bucket, _, prefix = stage.removeprefix("s3://").partition("/")
+    return json.dumps(
+        {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Action": ["s3:PutObject", "s3:DeleteObject"],
+                    "Resource": f"arn:aws:s3:::{bucket}/{prefix}*",
+                },
+                {
+                    "Effect": "Allow",
+                    "Action": "s3:ListBucket",
+                    "Resource": f"arn:aws:s3:::{bucket}",
+                    "Condition": {"StringLike": {"s3:prefix": f"{prefix}*"}},
+                },
+            ],
+        }
+    )
 
 
 def create_iam_role(iam: boto3.client, iam_RoleName: str = "dwh_iam_role") -> str:
     """
     Creates an IAM role for AWS Redshift with the specified name.
 
+    The role gets read-only S3 access, plus write access to the songplay_stage prefix.
+    If the role already exists, its ARN is looked up and the read-only S3 policy
+    is only attached if it is missing. A re-run therefore makes four IAM calls
+    (create_role, get_role, list_attached_role_policies, put_role_policy), one more
+    than before. put_role_policy always runs so the inline policy follows changes
+    to songplay_stage.
+
     Args:
         iam (boto3.client): Boto3 IAM client object.
         iam_RoleName (str): Name of the IAM role to be created. Defaults to "dwh_iam_role".
 
     Returns:
-        str: ARN (Amazon Resource Name) of the created IAM role.
+        str: ARN (Amazon Resource Name) of the IAM role.
 
     Raises:
-        Exception: If there is an error creating the IAM role or attaching the policy.
+        ClientError: If creating the role fails for a reason other than it already existing.
 
     Note:
         This function assumes that appropriate permissions are already configured to create IAM roles.
@@ -84,42 +154,69 @@ def create_iam_role(iam: boto3.client, iam_RoleName: str = "dwh_iam_role") -> st
                 }
             ),
         )
-    except Exception as e:
-        print(e)
-
-    iam.attach_role_policy(
+        roleArn = dwhRole["Role"]["Arn"]
+        attached_policies = []
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "EntityAlreadyExists":
+            raise
+        print(f"IAM Role {iam_RoleName} already exists")
+
+        roleArn = iam.get_role(RoleName=iam_RoleName)["Role"]["Arn"]
+
+        response = iam.list_attached_role_policies(RoleName=iam_RoleName)
+        attached_policies = [
+            policy["PolicyArn"] for policy in response["AttachedPolicies"]
+        ]
+
+    if S3_POLICY_ARN not in attached_policies:
+        iam.attach_role_policy(
+            RoleName=iam_RoleName,
+            PolicyArn=S3_POLICY_ARN,
+        )
+    iam.put_role_policy(
         RoleName=iam_RoleName,
-        PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess",
-    )["ResponseMetadata"]["HTTPStatusCode"]
+        PolicyName=SONGPLAY_STAGE_POLICY_NAME,
+        PolicyDocument=songplay_stage_policy(),
+    )
 
-    roleArn = iam.get_role(RoleName=iam_RoleName)["Role"]["Arn"]
-    print(f"The ARN of the IAM role was successfully created!\n{roleArn}")
+    print(f"The ARN of the IAM role is ready!\n{roleArn}")
 
     return roleArn
 
 
 def delete_iam_role(iam: boto3.client, iam_RoleName: str = "dwh_iam_role"):
     """
-    Deletes the specified IAM role.
+    Deletes the specified IAM role, after detaching its managed policies
+    and deleting its inline policies.
 
     Args:
         iam (boto3.client): Boto3 IAM client object.
         iam_RoleName (str): Name of the IAM role to be deleted. Defaults to "dwh_iam_role".
 
     Returns:
-        dict: The response from the IAM service indicating the status of the operation.
-
-    Raises:
-        Exception: If there is an error deleting the IAM role.
+        dict: The response from the IAM service indicating the status of the operation,
+            or None if the role was already deleted or could not be deleted.
     """
     print(f"Deleting IAM role named '{iam_RoleName}'")
-    iam.detach_role_policy(
-        RoleName=iam_RoleName,
-        PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess",
-    )
-    response = iam.delete_role(RoleName=iam_RoleName)
-    print(response)
+    try:
+        # Detach whatever is attached, roles created by older versions may differ
+        attached = iam.list_attached_role_policies(RoleName=iam_RoleName)
+        for policy in attached["AttachedPolicies"]:
+            iam.detach_role_policy(
+                RoleName=iam_RoleName, PolicyArn=policy["PolicyArn"]
+            )
+        inline = iam.list_role_policies(RoleName=iam_RoleName)
+        for policy_name in inline["PolicyNames"]:
+            iam.delete_role_policy(RoleName=iam_RoleName, PolicyName=policy_name)
+        response = iam.delete_role(RoleName=iam_RoleName)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchEntity":
+            print(f"IAM role '{iam_RoleName}' was already deleted")
+        else:
+            print(f"Error deleting IAM role: {e}")
+        return None
 
+    print(response)
     return response
 
 
@@ -153,15 +250,48 @@ def create_security_group(
     return security_group
 
 
+def _get_ec2_public_ip():
+    """
+    Retrieve the public IP address from the EC2 instance metadata service (IMDSv2).
+
+    Returns:
+        str: The public IP address, or None when not running on EC2.
+    """
+    try:
+        token = _SESSION.put(
+            f"{IMDS_URL}/api/token",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"},
+            timeout=IMDS_TIMEOUT,
+        )
+        token.raise_for_status()
+        response = _SESSION.get(
+            f"{IMDS_URL}/meta-data/public-ipv4",
+            headers={"X-aws-ec2-metadata-token": token.text},
+            timeout=IMDS_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.text.strip()
+    except requests.exceptions.RequestException:
+        return None
+
+
+@lru_cache(maxsize=1)
 def get_public_ip():
     """
-    Retrieve the public IP address of the local machine using the 'ifconfig.me' service.
+    Retrieve the public IP address of the local machine.
+
+    The EC2 instance metadata service is tried first, then the 'ifconfig.me' service.
+    The result is cached for the lifetime of the process.
 
     Returns:
         str: The public IP address as a string, or None if retrieval fails.
     """
+    public_ip = _get_ec2_public_ip()
+    if public_ip:
+        return public_ip
+
     try:
-        response = requests.get("https://ifconfig.me")
+        response = _SESSION.get("https://ifconfig.me", timeout=2)
         response.raise_for_status()  # Raise an exception for non-2xx status codes
         return response.text.strip()
     except requests.exceptions.RequestException as e:
@@ -192,6 +322,7 @@ def create_redshift_cluster(
         None
     """
     print("Creating Redshift Cluster")
+    config = get_config()
     try:
         response = redshift.create_cluster(
             # HW
@@ -199,10 +330,10 @@ def create_redshift_cluster(
             NodeType=node_type,
             NumberOfNodes=num_nodes,
             # Identifiers & Credentials
-            DBName=DB_NAME,
-            ClusterIdentifier=CLUSTER_ID,
-            MasterUsername=DB_USER,
-            MasterUserPassword=DB_PASSWORD,
+            DBName=config.get("CLUSTER", "DB_NAME"),
+            ClusterIdentifier=config.get("CLUSTER", "cluster_id"),
+            MasterUsername=config.get("CLUSTER", "DB_USER"),
+            MasterUserPassword=config.get("CLUSTER", "DB_PASSWORD"),
             VpcSecurityGroupIds=[SecurityGroupID],
             # Roles (for s3 access)
             IamRoles=[roleArn],
@@ -258,7 +389,9 @@ def get_cluster_info(redshift):
     """
     try:
         # Describe the cluster
-        response = redshift.describe_clusters(ClusterIdentifier="dwhCluster")
+        response = redshift.describe_clusters(
+            ClusterIdentifier=get_config().get("CLUSTER", "cluster_id")
+        )
 
         # Get the cluster status from the response
         cluster_status = response["Clusters"][0]["ClusterStatus"]
@@ -295,25 +428,60 @@ def delete_redshift_cluster(redshift, cluster_identifier):
         print(f"Error deleting cluster: {e}")
 
 
-def init():
+def wait_for_cluster(redshift, waiter_name: str, cluster_identifier: str) -> bool:
+    """
+    Block until the Redshift cluster reaches the state of the given boto3 waiter.
+
+    Args:
+        redshift (boto3.client): The Boto3 Redshift client.
+        waiter_name (str): The waiter to use, e.g. "cluster_available" or "cluster_deleted".
+        cluster_identifier (str): The identifier of the cluster to wait for.
+
+    Returns:
+        bool: True if the cluster reached the expected state, otherwise False.
+    """
+    try:
+        redshift.get_waiter(waiter_name).wait(
+            ClusterIdentifier=cluster_identifier, WaiterConfig=WAITER_CONFIG
+        )
+        return True
+    except WaiterError as e:
+        clusters = e.last_response.get("Clusters") or [{}]
+        cluster_status = clusters[0].get("ClusterStatus", "unknown")
+        print(
+            f"Error waiting for cluster '{cluster_identifier}' "
+            f"(status: {cluster_status}): {e}"
+        )
+        return False
+
+
+def init(wait: bool = False):
     """
     Initialize the setup process for Redshift.
 
     This function performs the following actions:
-    - Creates an IAM Role for Redshift with S3 Read Access.
+    - Creates an IAM Role for Redshift with S3 Access.
     - Creates a security group (firewall) for Redshift and allows connection from the local IP address.
     - Opens an incoming TCP port to access the cluster endpoint.
     - Creates a Redshift cluster.
     - Updates the configuration file with the IAM ARN.
+    - Optionally waits for the cluster to become available and stores its endpoint.
+
+    Args:
+        wait (bool, optional): Block until the cluster is available, then run `status`. Defaults to False.
 
     Raises:
         Exception: If retrieving the public IP address fails.
     """
-    # Create IAM Role for Redshift with S3 Read Access
-    iam_role = create_iam_role(iam)
+    config = get_config()
+    cluster_id = config.get("CLUSTER", "cluster_id")
+    db_port = int(config.get("CLUSTER", "DB_PORT"))
+
+    # Create IAM Role for Redshift with S3 Access
+    iam_role = create_iam_role(_iam())
 
     # Create security group (= firewall for Redshift) and allow connection from local IP
-    sec_group = create_security_group(ec2_client, ec2_resource)
+    sec_group = create_security_group(_ec2_client(), _ec2_resource())
     public_ip = get_public_ip()
     if public_ip:
         print(f"Public IP address: {public_ip}")
@@ -323,15 +491,15 @@ def init():
             GroupName=sec_group.group_name,
             CidrIp=f"{public_ip}/32",  # Use /32 to specify a single IP address
             IpProtocol="TCP",
-            FromPort=int(DB_PORT),
-            ToPort=int(DB_PORT),
+            FromPort=db_port,
+            ToPort=db_port,
         )
         print("Open Incoming TCP port to current public IP address")
     else:
         raise Exception("Failed to retrieve public IP address")
 
     # Add more nodes to make it faster
-    create_redshift_cluster(redshift, iam_role, sec_group.id, num_nodes=2)
+    create_redshift_cluster(_redshift(), iam_role, sec_group.id, num_nodes=2)
 
     # Update the config file with the IAM ARN
     config["IAM_ROLE"]["ARN"] = iam_role
@@ -339,6 +507,11 @@ def init():
         config.write(conf)
         print(f"Updated {CONFIG_FILENAME} with IAM ARN")
 
+    if wait:
+        print("Waiting for the Redshift cluster to become available")
+        if wait_for_cluster(_redshift(), "cluster_available", cluster_id):
+            status()
+
 
 def status():
     """
@@ -349,7 +522,8 @@ def status():
     cluster endpoint under the 'CLUSTER' section.
 
     """
-    cluster_status, dwh_endpoint = get_cluster_info(redshift)
+    config = get_config()
+    cluster_status, dwh_endpoint = get_cluster_info(_redshift())
 
     if cluster_status == "available":
         print("You are ready to use your Redshift cluster!")
@@ -368,12 +542,25 @@ def delete():
     Returns:
         None
     """
-    delete_iam_role(iam)
-    delete_redshift_cluster(redshift, CLUSTER_ID)
-    time.sleep(5)
-    delete_security_group(ec2_resource)
+    cluster_id = get_config().get("CLUSTER", "cluster_id")
+
+    # The IAM role and the cluster are independent, delete them concurrently
+    # Both helpers report their own errors, so the teardown always carries on
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        executor.submit(delete_iam_role, _iam())
+        executor.submit(delete_redshift_cluster, _redshift(), cluster_id)
+
+    # The security group can't be deleted while the cluster still uses it
+    print("Waiting for the Redshift cluster to be deleted")
+    if wait_for_cluster(_redshift(), "cluster_deleted", cluster_id):
+        delete_security_group(_ec2_resource())
+    else:
+        print(
+            "Security group not deleted. If the cluster was still being created, "
+            "run delete again once it is available, otherwise once it is deleted"
+        )
 
 
 if __name__ == "__main__":
-    # Usage : python redshift_iac.py init/status/delete
+    # Usage : python redshift_iac.py init [--wait]/status/delete
     fire.Fire({"init": init, "status": status, "delete": delete})
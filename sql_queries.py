@@ -1,8 +1,6 @@
-import configparser
+from psycopg import sql
 
-# CONFIG
-config = configparser.ConfigParser()
-config.read("dwh.cfg")
+from config import get_config
 
 # DROP TABLES
 
@@ -37,6 +35,7 @@ staging_events_table_create = """
             userAgent VARCHAR,
             userId BIGINT
         )
+        DISTKEY (userId)
 """
 
 staging_songs_table_create = """
@@ -56,106 +55,159 @@ staging_songs_table_create = """
 
 songplay_table_create = """
         CREATE TABLE IF NOT EXISTS songplays (
-            songplay_id BIGINT IDENTITY (0,1) PRIMARY KEY,
-            start_time TIMESTAMP NOT NULL REFERENCES time,
-            user_id BIGINT NOT NULL REFERENCES users,
-            level VARCHAR (4) NOT NULL,
-            song_id VARCHAR REFERENCES songs,
-            artist_id VARCHAR REFERENCES artists,
-            session_id INT,
-            location VARCHAR,
-            user_agent VARCHAR);
+            songplay_id BIGINT IDENTITY (0,1) ENCODE AZ64 PRIMARY KEY,
+            start_time TIMESTAMP ENCODE RAW NOT NULL REFERENCES time,
+            user_id BIGINT ENCODE AZ64 NOT NULL REFERENCES users,
+            level VARCHAR (4) ENCODE ZSTD NOT NULL,
+            song_id VARCHAR ENCODE ZSTD REFERENCES songs,
+            artist_id VARCHAR ENCODE ZSTD REFERENCES artists,
+            session_id INT ENCODE AZ64,
+            location VARCHAR ENCODE ZSTD,
+            user_agent VARCHAR ENCODE ZSTD)
+        DISTKEY (user_id)
+        SORTKEY (start_time);
 """
 
 user_table_create = """
-        CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY,
-                                          first_name VARCHAR NOT NULL,
-                                          last_name VARCHAR NOT NULL,
-                                          gender CHAR NOT NULL,
-                                          level VARCHAR (4) NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (user_id BIGINT ENCODE RAW PRIMARY KEY,
+                                          first_name VARCHAR ENCODE ZSTD NOT NULL,
+                                          last_name VARCHAR ENCODE ZSTD NOT NULL,
+                                          gender CHAR ENCODE ZSTD NOT NULL,
+                                          level VARCHAR (4) ENCODE ZSTD NOT NULL)
+        DISTSTYLE ALL
+        SORTKEY (user_id);
 """
 
 song_table_create = """
-        CREATE TABLE IF NOT EXISTS songs (song_id VARCHAR PRIMARY KEY,
-                                          title VARCHAR NOT NULL,
-                                          artist_id VARCHAR,
-                                          year INT,
-                                          duration NUMERIC NOT NULL);
+        CREATE TABLE IF NOT EXISTS songs (song_id VARCHAR ENCODE RAW PRIMARY KEY,
+                                          title VARCHAR ENCODE ZSTD NOT NULL,
+                                          artist_id VARCHAR ENCODE ZSTD,
+                                          year INT ENCODE AZ64,
+                                          duration NUMERIC ENCODE AZ64 NOT NULL)
+        DISTSTYLE ALL
+        SORTKEY (song_id);
 """
 
 artist_table_create = """
-        CREATE TABLE IF NOT EXISTS artists (artist_id VARCHAR PRIMARY KEY,
-                                            name VARCHAR NOT NULL,
-                                            location VARCHAR,
-                                            latitude FLOAT,
-                                            longitude FLOAT);
+        CREATE TABLE IF NOT EXISTS artists (artist_id VARCHAR ENCODE RAW PRIMARY KEY,
+                                            name VARCHAR ENCODE ZSTD NOT NULL,
+                                            location VARCHAR ENCODE ZSTD,
+                                            latitude FLOAT ENCODE ZSTD,
+                                            longitude FLOAT ENCODE ZSTD)
+        DISTSTYLE ALL
+        SORTKEY (artist_id);
 """
 
 time_table_create = """
-        CREATE TABLE IF NOT EXISTS time (start_time TIMESTAMP PRIMARY KEY,
-                                         hour INT,
-                                         day INT,
-                                         week INT,
-                                         month INT,
-                                         year INT,
-                                         weekday INT);
+        CREATE TABLE IF NOT EXISTS time (start_time TIMESTAMP ENCODE RAW PRIMARY KEY,
+                                         hour INT ENCODE AZ64,
+                                         day INT ENCODE AZ64,
+                                         week INT ENCODE AZ64,
+                                         month INT ENCODE AZ64,
+                                         year INT ENCODE AZ64,
+                                         weekday INT ENCODE AZ64)
+        DISTSTYLE ALL
+        SORTKEY (start_time);
 """
 
 # STAGING TABLES
 
-staging_events_copy = (
+# COPY templates, filled in with query_params()
+staging_events_copy = sql.SQL(
     """
-        COPY staging_events FROM {}
-        credentials 'aws_iam_role={}'
-        JSON {} compupdate off
+        COPY staging_events FROM {log_data}
+        IAM_ROLE {iam_role}
+        JSON {log_jsonpath} truncatecolumns blanksasnull emptyasnull
+        compupdate off statupdate off
         region 'us-west-2'
         timeformat as 'epochmillisecs';
 """
-).format(
-    config.get("S3", "LOG_DATA"),
-    config.get("IAM_ROLE", "ARN"),
-    config.get("S3", "LOG_JSONPATH"),
 )
 
-staging_songs_copy = (
+staging_songs_copy = sql.SQL(
     """
-        COPY staging_songs FROM {}
-        credentials 'aws_iam_role={}'
-        JSON 'auto' truncatecolumns compupdate off
+        COPY staging_songs FROM {song_data}
+        IAM_ROLE {iam_role}
+        JSON 'auto' truncatecolumns blanksasnull emptyasnull
+        compupdate off statupdate off
         region 'us-west-2';
 """
-).format(config.get("S3", "SONG_DATA"), config.get("IAM_ROLE", "ARN"))
+)
+
+# COPY runs with statupdate off, so statistics are refreshed explicitly
+# once both staging tables are loaded
+staging_events_analyze = "ANALYZE staging_events"
+staging_songs_analyze = "ANALYZE staging_songs"
 
 # FINAL TABLES
 
-songplay_table_insert = """
-        INSERT INTO songplays (start_time, user_id, level, song_id, artist_id,
-                               session_id, location, user_agent)
+# Inserts reading staging_events first project the few columns they need
+# and keep only NextSong events, so less of the wide table is scanned
+
+songplay_select = """
+        WITH e AS (
+            SELECT ts, userId, level, sessionId, location, userAgent,
+                   artist, song, length
+            FROM staging_events
+            WHERE page = 'NextSong'
+            AND userId IS NOT NULL
+        )
         SELECT e.ts AS start_time,
                e.userId AS user_id,
                e.level,
                s.song_id AS song_id,
                s.artist_id AS artist_id,
-               e.sessionId AS session_id,
+               CAST(e.sessionId AS INT) AS session_id,
                e.location,
                e.userAgent AS user_agent
-        FROM staging_events e
+        FROM e
         JOIN staging_songs s ON e.artist = s.artist_name
         AND e.length = s.duration
         AND e.song = s.title
 """
 
+# The fact table is unloaded to S3 as Parquet and bulk loaded back with COPY,
+# which runs in parallel on the compute nodes instead of INSERT ... SELECT
+songplay_unload = sql.SQL(
+    """
+        UNLOAD ({songplay_select})
+        TO {songplay_stage}
+        IAM_ROLE {iam_role}
+        FORMAT AS PARQUET
+        PARALLEL ON
+        CLEANPATH;
+"""
+)
+
+songplay_copy = sql.SQL(
+    """
+        COPY songplays (start_time, user_id, level, song_id, artist_id,
+                        session_id, location, user_agent)
+        FROM {songplay_stage}
+        IAM_ROLE {iam_role}
+        FORMAT AS PARQUET;
+"""
+)
+
 user_table_insert = """
         INSERT INTO users (user_id, first_name, last_name, gender, level)
-        SELECT DISTINCT userId AS user_id,
-               firstName AS first_name,
-               lastName AS last_name,
-               gender,
-               level
-        FROM staging_events
-        WHERE page = 'NextSong'
-        AND user_id IS NOT null
-        AND ts = (SELECT max(ts) FROM staging_events WHERE user_id = userId);
+        WITH e AS (
+            SELECT userId, firstName, lastName, gender, level, ts
+            FROM staging_events
+            WHERE page = 'NextSong'
+            AND userId IS NOT NULL
+        )
+        SELECT user_id, first_name, last_name, gender, level
+        FROM (
+            SELECT userId AS user_id,
+                   firstName AS first_name,
+                   lastName AS last_name,
+                   gender,
+                   level,
+                   ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS rn
+            FROM e
+        ) AS latest
+        WHERE latest.rn = 1;
 """
 
 song_table_insert = """
@@ -180,27 +232,35 @@ artist_table_insert = """
 
 time_table_insert = """
         INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-        SELECT DISTINCT ts AS start_time,
+        WITH t AS (
+            SELECT DISTINCT ts AS start_time
+            FROM staging_events
+            WHERE page = 'NextSong'
+            AND userId IS NOT NULL
+        )
+        SELECT start_time,
                EXTRACT(hour FROM start_time) AS hour,
                EXTRACT(day FROM start_time) AS day,
                EXTRACT(week FROM start_time) AS week,
                EXTRACT(month FROM start_time) AS month,
                EXTRACT(year FROM start_time) AS year,
                EXTRACT(DOW FROM start_time) AS weekday
-        FROM staging_events
+        FROM t
 """
 
 # QUERY LISTS
 
-create_table_queries = [
+# songplays references the dimension tables, every other table can be
+# created independently
+independent_create_table_queries = [
     staging_events_table_create,
     staging_songs_table_create,
     user_table_create,
     song_table_create,
     artist_table_create,
     time_table_create,
-    songplay_table_create,
 ]
+create_table_queries = independent_create_table_queries + [songplay_table_create]
 drop_table_queries = [
     staging_events_table_drop,
     staging_songs_table_drop,
@@ -211,10 +271,34 @@ drop_table_queries = [
     time_table_drop,
 ]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [
-    songplay_table_insert,
+analyze_staging_queries = [staging_events_analyze, staging_songs_analyze]
+dimension_table_queries = [
     user_table_insert,
     song_table_insert,
     artist_table_insert,
     time_table_insert,
 ]
+fact_table_queries = [songplay_unload, songplay_copy]
+
+# QUERY PARAMETERS
+
+
+def query_params():
+    """
+    Returns the values used to fill in the COPY and UNLOAD templates:
+    the S3 locations and IAM role from dwh.cfg and the songplays query,
+    all as SQL literals
+    """
+    config = get_config()
+    values = {
+        "log_data": config.get("S3", "LOG_DATA"),
+        "log_jsonpath": config.get("S3", "LOG_JSONPATH"),
+        "song_data": config.get("S3", "SONG_DATA"),
+        "songplay_stage": config.get("S3", "SONGPLAY_STAGE"),
+        "iam_role": config.get("IAM_ROLE", "ARN"),
+    }
+    # Older dwh.cfg files quote the S3 URIs themselves
+    params = {name: sql.Literal(value.strip("'")) for name, value in values.items()}
+    params["songplay_select"] = sql.Literal(songplay_select)
+    return params
+